@@ -1,846 +1,1174 @@
-import asyncio
-import os
-import re
-import json
-import hashlib
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
-
-import aiohttp
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import (
-    Message,
-    InlineKeyboardMarkup,
-    InlineKeyboardButton,
-    CallbackQuery,
-)
-from bs4 import BeautifulSoup
-from dotenv import load_dotenv
-
-# =========================
-# CONFIG
-# =========================
-load_dotenv()
-
-BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
-ADMIN_ID = int((os.getenv("ADMIN_ID", "0") or "0").strip() or "0")
-
-URL = "https://www.roe.vsei.ua/disconnections/"
-TZ = ZoneInfo("Europe/Kyiv")
-
-SITE_CHECK_EVERY_SECONDS = 300          # 5 хв
-PREALERT_WINDOW_SECONDS = 120           # 2 хв вікно
-DEFAULT_NOTICE_MINUTES = 10
-ALLOWED_NOTICE = {5, 10, 30}
-
-STATE_FILE = "state.json"
-
-# Парсинг
-TIME_RANGE_RE = re.compile(r"(\d{2}:\d{2})\s*-\s*(\d{2}:\d{2})")
-UPDATE_RE = re.compile(r"Оновлено:\s*\d{2}\.\d{2}\.\d{4}\s*\d{2}:\d{2}")
-DATE_RE = re.compile(r"\b(\d{2}\.\d{2}\.\d{4})\b")
-
-# =========================
-# BOT INIT
-# =========================
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN is missing. Add BOT_TOKEN to environment variables.")
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-# =========================
-# IN-MEMORY STATE
-# =========================
-USER_SUBQUEUE: dict[int, str] = {}
-USER_NOTICE: dict[int, int] = {}
-
-USER_LAST_HASH: dict[int, str] = {}
-USER_LAST_SCHEDULE: dict[int, dict[str, list[tuple[str, str]]]] = {}
-USER_LAST_UPDATE_MARKER: dict[int, str | None] = {}
-
-USER_NOTIFIED_KEYS: dict[int, set[str]] = {}
-ALL_USERS: set[int] = set()
-
-# cached last global parse (all subqueues)
-_last_global_schedules: dict[str, dict[str, list[tuple[str, str]]]] = {}
-_last_global_update_marker: str | None = None
-
-
-# =========================
-# PERSISTENCE
-# =========================
-def load_state() -> None:
-    global USER_SUBQUEUE, USER_NOTICE, ALL_USERS
-    try:
-        if not os.path.exists(STATE_FILE):
-            return
-
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        users = data.get("users", {})
-        for chat_id_str, u in users.items():
-            try:
-                cid = int(chat_id_str)
-            except ValueError:
-                continue
-
-            ALL_USERS.add(cid)
-
-            sq = (u.get("subqueue") or "").strip()
-            if sq:
-                USER_SUBQUEUE[cid] = sq
-
-            notice = u.get("notice")
-            if isinstance(notice, int) and notice in ALLOWED_NOTICE:
-                USER_NOTICE[cid] = notice
-            else:
-                USER_NOTICE.setdefault(cid, DEFAULT_NOTICE_MINUTES)
-
-    except Exception as e:
-        print(f"[STATE] load_state failed: {e}")
-
-
-def save_state() -> None:
-    try:
-        users_obj: dict[str, dict] = {}
-        for cid in ALL_USERS:
-            users_obj[str(cid)] = {
-                "subqueue": USER_SUBQUEUE.get(cid),
-                "notice": USER_NOTICE.get(cid, DEFAULT_NOTICE_MINUTES),
-            }
-
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump({"users": users_obj}, f, ensure_ascii=False, indent=2)
-
-    except Exception as e:
-        print(f"[STATE] save_state failed: {e}")
-
-
-def register_user(chat_id: int) -> None:
-    if chat_id not in ALL_USERS:
-        ALL_USERS.add(chat_id)
-    if chat_id not in USER_NOTICE:
-        USER_NOTICE[chat_id] = DEFAULT_NOTICE_MINUTES
-    save_state()
-
-
-# =========================
-# UI (KEYBOARDS)
-# =========================
-def keyboard_choose_subqueue() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="1.1", callback_data="sq:1.1"),
-         InlineKeyboardButton(text="1.2", callback_data="sq:1.2")],
-        [InlineKeyboardButton(text="2.1", callback_data="sq:2.1"),
-         InlineKeyboardButton(text="2.2", callback_data="sq:2.2")],
-        [InlineKeyboardButton(text="3.1", callback_data="sq:3.1"),
-         InlineKeyboardButton(text="3.2", callback_data="sq:3.2")],
-        [InlineKeyboardButton(text="4.1", callback_data="sq:4.1"),
-         InlineKeyboardButton(text="4.2", callback_data="sq:4.2")],
-        [InlineKeyboardButton(text="5.1", callback_data="sq:5.1"),
-         InlineKeyboardButton(text="5.2", callback_data="sq:5.2")],
-        [InlineKeyboardButton(text="6.1", callback_data="sq:6.1"),
-         InlineKeyboardButton(text="6.2", callback_data="sq:6.2")],
-    ])
-
-
-def keyboard_main() -> InlineKeyboardMarkup:
-    # Кнопки керування (без /next та /schedule)
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔴 Поточний стан", callback_data="main:status")],
-        [InlineKeyboardButton(text="🔔 Налаштувати попередження", callback_data="main:notice")],
-        [InlineKeyboardButton(text="🔁 Змінити підчергу", callback_data="main:change"),
-         InlineKeyboardButton(text="❌ Вимкнути сповіщення", callback_data="main:stop")],
-    ])
-
-
-def keyboard_notice(cur: int) -> InlineKeyboardMarkup:
-    def btn(val: int) -> InlineKeyboardButton:
-        mark = " ✅" if cur == val else ""
-        return InlineKeyboardButton(text=f"⏱ {val} хв{mark}", callback_data=f"notice:{val}")
-
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [btn(5), btn(10), btn(30)],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="main:back")],
-    ])
-
-
-async def send_main_menu(chat_id: int, text: str) -> None:
-    await bot.send_message(chat_id, text, reply_markup=keyboard_main())
-
-
-# =========================
-# HTTP / PARSING
-# =========================
-async def fetch_html() -> str:
-    timeout = aiohttp.ClientTimeout(total=25)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.get(URL) as r:
-            r.raise_for_status()
-            return await r.text()
-
-
-def _find_update_marker(full_text: str) -> str | None:
-    m = UPDATE_RE.search(full_text)
-    return m.group(0) if m else None
-
-
-def _html_table_to_matrix(table) -> list[list[str]]:
-    """
-    Перетворює HTML-таблицю в матрицю з урахуванням rowspan/colspan.
-    """
-    rows = table.find_all("tr")
-    grid: list[list[str]] = []
-    span_map: dict[tuple[int, int], dict] = {}
-
-    for r_idx, tr in enumerate(rows):
-        cells = tr.find_all(["th", "td"])
-        grid_row: list[str] = []
-        c_idx = 0
-
-        def fill_spans_until_free() -> None:
-            nonlocal c_idx
-            while (r_idx, c_idx) in span_map:
-                info = span_map[(r_idx, c_idx)]
-                grid_row.append(info["text"])
-                if info["rows_left"] > 1:
-                    span_map[(r_idx + 1, c_idx)] = {
-                        "text": info["text"],
-                        "rows_left": info["rows_left"] - 1,
-                    }
-                del span_map[(r_idx, c_idx)]
-                c_idx += 1
-
-        for cell in cells:
-            fill_spans_until_free()
-
-            text = cell.get_text(" ", strip=True)
-            rowspan = int(cell.get("rowspan", 1))
-            colspan = int(cell.get("colspan", 1))
-
-            for _ in range(colspan):
-                grid_row.append(text)
-                c_idx += 1
-
-            if rowspan > 1:
-                for col in range(c_idx - colspan, c_idx):
-                    span_map[(r_idx + 1, col)] = {"text": text, "rows_left": rowspan - 1}
-
-        fill_spans_until_free()
-        grid.append(grid_row)
-
-    max_cols = max((len(r) for r in grid), default=0)
-    for r in grid:
-        if len(r) < max_cols:
-            r.extend([""] * (max_cols - len(r)))
-
-    return grid
-
-
-def _parse_date_from_row(row: list[str]) -> str | None:
-    for cell in row:
-        if not cell:
-            continue
-        m = DATE_RE.search(cell)
-        if m:
-            return m.group(1)
-    return None
-
-
-def parse_all_schedules(html: str) -> tuple[str | None, dict[str, dict[str, list[tuple[str, str]]]]]:
-    """
-    Повертає:
-      update_marker,
-      schedules_all: { "5.1": { "08.02.2026": [("00:00","05:00"), ...], "09.02.2026": [...] }, ... }
-    """
-    soup = BeautifulSoup(html, "lxml")
-    full_text = soup.get_text("\n", strip=True)
-    update_marker = _find_update_marker(full_text)
-
-    table = None
-    for t in soup.find_all("table"):
-        tt = t.get_text(" ", strip=True)
-        if "Підчерга" in tt and "1.1" in tt and "6.2" in tt:
-            table = t
-            break
-    if table is None:
-        return update_marker, {}
-
-    matrix = _html_table_to_matrix(table)
-    if not matrix:
-        return update_marker, {}
-
-    subqueues = [f"{i}.{j}" for i in range(1, 7) for j in (1, 2)]
-    col_map: dict[str, int] = {}
-    header_row_idx: int | None = None
-
-    # шукаємо рядок з підчергами (де багато збігів)
-    for r_i, row in enumerate(matrix):
-        found: list[tuple[str, int]] = []
-        for sq in subqueues:
-            for c_i, cell in enumerate(row):
-                if (cell or "").strip() == sq:
-                    found.append((sq, c_i))
-        if len(found) >= 6:
-            header_row_idx = r_i
-            for sq, c_i in found:
-                col_map[sq] = c_i
-            break
-
-    if header_row_idx is None or not col_map:
-        return update_marker, {}
-
-    schedules: dict[str, dict[str, list[tuple[str, str]]]] = {sq: {} for sq in col_map.keys()}
-    current_date: str | None = None
-
-    for row in matrix[header_row_idx + 1:]:
-        row_date = _parse_date_from_row(row)
-        if row_date:
-            current_date = row_date
-
-        if not current_date:
-            continue
-
-        for sq, c_i in col_map.items():
-            if c_i >= len(row):
-                continue
-            cell_text = (row[c_i] or "").strip()
-            if not cell_text:
-                continue
-            if "Очікується" in cell_text:
-                continue
-
-            intervals = TIME_RANGE_RE.findall(cell_text)
-            if not intervals:
-                continue
-
-            day_map = schedules[sq].setdefault(current_date, [])
-            for a, b in intervals:
-                day_map.append((a, b))
-
-    # дедуп по днях
-    for sq, day_map in schedules.items():
-        for d, intervals in list(day_map.items()):
-            uniq: list[tuple[str, str]] = []
-            seen: set[tuple[str, str]] = set()
-            for it in intervals:
-                if it not in seen:
-                    uniq.append(it)
-                    seen.add(it)
-            day_map[d] = uniq
-
-    schedules = {sq: dm for sq, dm in schedules.items() if any(dm.values())}
-    return update_marker, schedules
-
-
-def _date_sort_key(d: str) -> tuple[int, int, int]:
-    try:
-        dd, mm, yy = d.split(".")
-        return (int(yy), int(mm), int(dd))
-    except Exception:
-        return (9999, 99, 99)
-
-
-def schedule_hash(schedule_by_day: dict[str, list[tuple[str, str]]]) -> str:
-    parts: list[str] = []
-    for d in sorted(schedule_by_day.keys(), key=_date_sort_key):
-        parts.append(d)
-        for a, b in schedule_by_day[d]:
-            parts.append(f"{a}-{b}")
-    raw = "|".join(parts)
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
-
-
-def format_schedule_all_days(subqueue: str, schedule_by_day: dict[str, list[tuple[str, str]]], update_marker: str | None) -> str:
-    if not schedule_by_day:
-        msg = (
-            f"Графік (ВІДКЛЮЧЕННЯ) для {subqueue}:\n"
-            f"⚠️ Інтервали не знайдено (можливо “Очікується” або змінилась таблиця)."
-        )
-        if update_marker:
-            msg += f"\n\n{update_marker}"
-        return msg
-
-    lines: list[str] = []
-    for d in sorted(schedule_by_day.keys(), key=_date_sort_key):
-        lines.append(f"{d} (ВІДКЛЮЧЕННЯ):")
-        for a, b in schedule_by_day[d]:
-            lines.append(f"• {a}–{b}")
-        lines.append("")
-
-    msg = "\n".join(lines).strip()
-    if update_marker:
-        msg += f"\n\n{update_marker}"
-    return msg
-
-
-def _dt_for_date(d_str: str, hhmm: str) -> datetime:
-    dd, mm, yy = d_str.split(".")
-    hh, mn = hhmm.split(":")
-    return datetime(int(yy), int(mm), int(dd), int(hh), int(mn), 0, tzinfo=TZ)
-
-
-def _interval_end_dt(d_str: str, hhmm: str) -> datetime:
-    dt = _dt_for_date(d_str, hhmm)
-    if hhmm == "23:59":
-        dt = dt.replace(second=59)
-    return dt
-
-
-def is_off_now(schedule_by_day: dict[str, list[tuple[str, str]]], now: datetime) -> bool:
-    today_str = now.strftime("%d.%m.%Y")
-    intervals = schedule_by_day.get(today_str, [])
-    for a, b in intervals:
-        st = _dt_for_date(today_str, a)
-        en = _interval_end_dt(today_str, b)
-        if st <= now <= en:
-            return True
-    return False
-
-
-def next_event(schedule_by_day: dict[str, list[tuple[str, str]]], now: datetime) -> tuple[datetime | None, str | None]:
-    today_str = now.strftime("%d.%m.%Y")
-
-    # якщо зараз OFF - найближче ON (кінець поточного інтервалу)
-    today_intervals = schedule_by_day.get(today_str, [])
-    for a, b in today_intervals:
-        st = _dt_for_date(today_str, a)
-        en = _interval_end_dt(today_str, b)
-        if st <= now <= en:
-            return en, "ON"
-
-    # інакше шукаємо найближчий старт OFF у майбутньому (по всіх днях)
-    candidates: list[datetime] = []
-    for d, intervals in schedule_by_day.items():
-        for a, _b in intervals:
-            st = _dt_for_date(d, a)
-            if st > now:
-                candidates.append(st)
-
-    if candidates:
-        return min(candidates), "OFF"
-
-    return None, None
-
-
-# =========================
-# LOOPS
-# =========================
-async def process_site_once(send_updates: bool = True) -> None:
-    global _last_global_schedules, _last_global_update_marker
-
-    html = await fetch_html()
-    update_marker, schedules_all = parse_all_schedules(html)
-
-    _last_global_schedules = schedules_all
-    _last_global_update_marker = update_marker
-
-    for chat_id, subqueue in list(USER_SUBQUEUE.items()):
-        schedule_by_day = schedules_all.get(subqueue, {})
-        USER_LAST_SCHEDULE[chat_id] = schedule_by_day
-        USER_LAST_UPDATE_MARKER[chat_id] = update_marker
-
-        new_hash = schedule_hash(schedule_by_day)
-        old_hash = USER_LAST_HASH.get(chat_id)
-
-        if old_hash is None:
-            USER_LAST_HASH[chat_id] = new_hash
-            USER_NOTIFIED_KEYS.setdefault(chat_id, set())
-            continue
-
-        if send_updates and new_hash != old_hash:
-            USER_LAST_HASH[chat_id] = new_hash
-            USER_NOTIFIED_KEYS[chat_id] = set()
-
-            text = (
-                f"🔄 Оновився графік по підчерзі {subqueue}\n\n"
-                f"{format_schedule_all_days(subqueue, schedule_by_day, update_marker)}"
-            )
-            await send_main_menu(chat_id, text)
-
-
-async def site_watcher_loop() -> None:
-    while True:
-        try:
-            if USER_SUBQUEUE:
-                await process_site_once(send_updates=True)
-        except Exception as e:
-            print(f"[WATCHER] loop error: {e}")
-        await asyncio.sleep(SITE_CHECK_EVERY_SECONDS)
-
-
-async def reminders_loop() -> None:
-    while True:
-        try:
-            now = datetime.now(TZ)
-
-            for chat_id, subqueue in list(USER_SUBQUEUE.items()):
-                schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
-                if not schedule_by_day:
-                    continue
-
-                notice = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
-                if notice not in ALLOWED_NOTICE:
-                    notice = DEFAULT_NOTICE_MINUTES
-                    USER_NOTICE[chat_id] = notice
-
-                notified = USER_NOTIFIED_KEYS.setdefault(chat_id, set())
-                day_key = now.strftime("%Y-%m-%d")
-
-                event_dt, event_type = next_event(schedule_by_day, now)
-                if not event_dt or not event_type:
-                    continue
-
-                notify_time = event_dt - timedelta(minutes=notice)
-
-                if notify_time <= now < notify_time + timedelta(seconds=PREALERT_WINDOW_SECONDS):
-                    key = f"{day_key}|{subqueue}|{event_type}|{event_dt.isoformat()}|{notice}"
-                    if key in notified:
-                        continue
-                    notified.add(key)
-
-                    hhmm = event_dt.strftime("%H:%M")
-
-                    # OFF = відключення, ON = відновлення
-                    if event_type == "OFF":
-                        text = f"❌ За {notice} хвилин можливе відключення світла (о {hhmm})"
-                    else:
-                        text = f"✅ За {notice} хвилин очікується відновлення світла (о {hhmm})"
-
-                    await bot.send_message(chat_id, text)
-
-        except Exception as e:
-            print(f"[REMINDERS] loop error: {e}")
-
-        await asyncio.sleep(60)
-
-
-# =========================
-# USER HELPERS
-# =========================
-def build_status_text(chat_id: int) -> str:
-    subqueue = USER_SUBQUEUE.get(chat_id)
-    if not subqueue:
-        return "⚠️ Спочатку обери підчергу через /start"
-
-    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
-    if not schedule_by_day:
-        return "⚠️ Зараз немає даних по графіку (можливо 'Очікується'). Спробуй /schedule пізніше."
-
-    now = datetime.now(TZ)
-    off = is_off_now(schedule_by_day, now)
-    ev_dt, ev_type = next_event(schedule_by_day, now)
-
-    txt = "❌ ЗАРАЗ ВІДКЛЮЧЕННЯ" if off else "✅ ЗАРАЗ Є СВІТЛО"
-    tail = ""
-    if ev_dt and ev_type:
-        hhmm = ev_dt.strftime("%H:%M")
-        if ev_type == "OFF":
-            tail = f"\nНайближче: відключення о {hhmm}"
-        else:
-            tail = f"\nНайближче: відновлення о {hhmm}"
-
-    return f"{txt}\nПідчерга: {subqueue}{tail}"
-
-
-# =========================
-# USER COMMANDS
-# =========================
-@dp.message(F.text == "/start")
-async def start(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-
-    await message.answer(
-        "Оберіть вашу підчергу.\n👇 Натисни кнопку:",
-        reply_markup=keyboard_choose_subqueue()
-    )
-
-
-@dp.message(F.text == "/status")
-async def cmd_status(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-    await send_main_menu(chat_id, build_status_text(chat_id))
-
-
-@dp.message(F.text == "/notice")
-async def cmd_notice(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-    cur = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
-    await message.answer(
-        f"Оберіть за скільки хвилин попереджати.\nПоточне: {cur} хв",
-        reply_markup=keyboard_notice(cur)
-    )
-
-
-@dp.message(F.text == "/change")
-async def cmd_change(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-    await message.answer("Ок, обери нову підчергу 👇", reply_markup=keyboard_choose_subqueue())
-
-
-@dp.message(F.text == "/stop")
-async def cmd_stop(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-
-    USER_SUBQUEUE.pop(chat_id, None)
-    USER_LAST_HASH.pop(chat_id, None)
-    USER_LAST_SCHEDULE.pop(chat_id, None)
-    USER_LAST_UPDATE_MARKER.pop(chat_id, None)
-    USER_NOTIFIED_KEYS.pop(chat_id, None)
-
-    save_state()
-    await message.answer("Сповіщення вимкнув ✅\nЩоб знову увімкнути — натисни /start")
-
-
-# Технічні команди (без кнопок)
-@dp.message(F.text == "/schedule")
-async def cmd_schedule(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-
-    subqueue = USER_SUBQUEUE.get(chat_id)
-    if not subqueue:
-        await message.answer("⚠️ Спочатку обери підчергу через /start")
-        return
-
-    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
-    update_marker = USER_LAST_UPDATE_MARKER.get(chat_id) or _last_global_update_marker
-    await send_main_menu(chat_id, format_schedule_all_days(subqueue, schedule_by_day, update_marker))
-
-
-@dp.message(F.text == "/next")
-async def cmd_next(message: Message) -> None:
-    chat_id = message.chat.id
-    register_user(chat_id)
-
-    subqueue = USER_SUBQUEUE.get(chat_id)
-    if not subqueue:
-        await message.answer("⚠️ Спочатку обери підчергу через /start")
-        return
-
-    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
-    if not schedule_by_day:
-        await message.answer("⚠️ Немає даних по графіку (можливо 'Очікується').")
-        return
-
-    now = datetime.now(TZ)
-    ev_dt, ev_type = next_event(schedule_by_day, now)
-    if not ev_dt or not ev_type:
-        await message.answer("⚠️ Немає наступних подій у доступному графіку.")
-        return
-
-    hhmm = ev_dt.strftime("%H:%M")
-    dstr = ev_dt.strftime("%d.%m.%Y")
-    if ev_type == "OFF":
-        await send_main_menu(chat_id, f"❌ Наступне відключення: {dstr} о {hhmm}")
-    else:
-        await send_main_menu(chat_id, f"✅ Наступне відновлення: {dstr} о {hhmm}")
-
-
-# =========================
-# CALLBACKS
-# =========================
-@dp.callback_query(F.data.startswith("sq:"))
-async def choose_subqueue(cb: CallbackQuery) -> None:
-    if cb.message is None:
-        return
-
-    chat_id = cb.message.chat.id
-    register_user(chat_id)
-
-    subqueue = cb.data.split(":", 1)[1].strip()
-    USER_SUBQUEUE[chat_id] = subqueue
-    USER_NOTIFIED_KEYS.setdefault(chat_id, set())
-    save_state()
-
-    await cb.answer()
-
-    try:
-        # оновити кеш з сайту (без пушів)
-        await process_site_once(send_updates=False)
-
-        schedule_by_day = _last_global_schedules.get(subqueue, {})
-        update_marker = _last_global_update_marker
-
-        USER_LAST_SCHEDULE[chat_id] = schedule_by_day
-        USER_LAST_UPDATE_MARKER[chat_id] = update_marker
-        USER_LAST_HASH[chat_id] = schedule_hash(schedule_by_day)
-        USER_NOTIFIED_KEYS[chat_id] = set()
-
-        notice = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
-
-        text = (
-            f"✅ Підчерга {subqueue} обрана\n"
-            f"⏱ Попередження: за {notice} хв\n\n"
-            f"{format_schedule_all_days(subqueue, schedule_by_day, update_marker)}"
-        )
-        await send_main_menu(chat_id, text)
-
-    except Exception as e:
-        print(f"[CHOOSE] failed: {e}")
-        await send_main_menu(
-            chat_id,
-            f"✅ Підчерга {subqueue} обрана\n\n"
-            "⚠️ Не зміг зараз отримати графік із сайту. Спробуй ще раз через хвилину."
-        )
-
-
-@dp.callback_query(F.data.startswith("main:"))
-async def main_buttons(cb: CallbackQuery) -> None:
-    if cb.message is None:
-        return
-
-    chat_id = cb.message.chat.id
-    register_user(chat_id)
-
-    action = cb.data.split(":", 1)[1].strip()
-    await cb.answer()
-
-    if action == "status":
-        await send_main_menu(chat_id, build_status_text(chat_id))
-        return
-
-    if action == "notice":
-        cur = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
-        await cb.message.answer(
-            f"Оберіть за скільки хвилин попереджати.\nПоточне: {cur} хв",
-            reply_markup=keyboard_notice(cur)
-        )
-        return
-
-    if action == "change":
-        await cb.message.answer("Ок, обери нову підчергу 👇", reply_markup=keyboard_choose_subqueue())
-        return
-
-    if action == "stop":
-        USER_SUBQUEUE.pop(chat_id, None)
-        USER_LAST_HASH.pop(chat_id, None)
-        USER_LAST_SCHEDULE.pop(chat_id, None)
-        USER_LAST_UPDATE_MARKER.pop(chat_id, None)
-        USER_NOTIFIED_KEYS.pop(chat_id, None)
-        save_state()
-
-        await cb.message.answer("Сповіщення вимкнув ✅\nЩоб знову увімкнути — натисни /start")
-        return
-
-    if action == "back":
-        await send_main_menu(chat_id, build_status_text(chat_id))
-        return
-
-
-@dp.callback_query(F.data.startswith("notice:"))
-async def choose_notice(cb: CallbackQuery) -> None:
-    if cb.message is None:
-        return
-
-    chat_id = cb.message.chat.id
-    register_user(chat_id)
-
-    try:
-        val = int(cb.data.split(":", 1)[1])
-    except ValueError:
-        await cb.answer("Помилка", show_alert=True)
-        return
-
-    if val not in ALLOWED_NOTICE:
-        await cb.answer("Доступно: 5/10/30", show_alert=True)
-        return
-
-    USER_NOTICE[chat_id] = val
-    save_state()
-
-    await cb.answer("Збережено ✅")
-    await send_main_menu(chat_id, f"✅ Ок. Попереджатиму за {val} хв до події.")
-
-
-# =========================
-# ADMIN COMMANDS
-# =========================
-def is_admin(message: Message) -> bool:
-    return ADMIN_ID != 0 and message.from_user and message.from_user.id == ADMIN_ID
-
-
-@dp.message(F.text.startswith("/bc"))
-async def admin_broadcast(message: Message) -> None:
-    if not is_admin(message):
-        return
-
-    text = message.text.replace("/bc", "", 1).strip()
-    if not text:
-        await message.answer("Формат:\n/bc ваш текст повідомлення")
-        return
-
-    ok, fail = 0, 0
-    for cid in list(ALL_USERS):
-        try:
-            await bot.send_message(cid, text)
-            ok += 1
-            await asyncio.sleep(0.05)  # м'який анти-флуд
-        except Exception:
-            fail += 1
-
-    await message.answer(f"Розсилка: ✅{ok} ❌{fail}")
-
-
-@dp.message(F.text == "/stats")
-async def admin_stats(message: Message) -> None:
-    if not is_admin(message):
-        return
-
-    total = len(ALL_USERS)
-    active = len(USER_SUBQUEUE)
-    await message.answer(
-        f"📊 Статистика:\n"
-        f"👥 Всього користувачів: {total}\n"
-        f"🔔 З активними сповіщеннями: {active}"
-    )
-
-
-@dp.message(F.text == "/force")
-async def admin_force(message: Message) -> None:
-    if not is_admin(message):
-        return
-
-    await message.answer("⏳ Ок, перевіряю сайт зараз...")
-    try:
-        await process_site_once(send_updates=True)
-        await message.answer("✅ Готово.")
-    except Exception as e:
-        await message.answer(f"⚠️ Помилка: {e}")
-
-
-@dp.message(F.text == "/time")
-async def admin_time(message: Message) -> None:
-    if not is_admin(message):
-        return
-    now = datetime.now(TZ)
-    await message.answer(f"Server time: {now.strftime('%d.%m.%Y %H:%M:%S')} (Europe/Kyiv)")
-
-
-# =========================
-# MAIN
-# =========================
-async def main() -> None:
-    load_state()
-
-    # Initial fetch (non-fatal)
-    try:
-        await process_site_once(send_updates=False)
-    except Exception as e:
-        print(f"[INIT] initial fetch failed: {e}")
-
-    asyncio.create_task(site_watcher_loop())
-    asyncio.create_task(reminders_loop())
-
-    await dp.start_polling(bot)
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
+import asyncio
+import bisect
+import functools
+import os
+import re
+import json
+import random
+import hashlib
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import aiohttp
+from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import (
+    Message,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    CallbackQuery,
+)
+import lxml.html
+from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:  # опційне прискорення, stdlib json як запасний варіант
+    orjson = None
+
+# =========================
+# CONFIG
+# =========================
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+ADMIN_ID = int((os.getenv("ADMIN_ID", "0") or "0").strip() or "0")
+
+URL = "https://www.roe.vsei.ua/disconnections/"
+TZ = ZoneInfo("Europe/Kyiv")
+
+SITE_CHECK_EVERY_SECONDS = 300          # 5 хв
+PREALERT_WINDOW_SECONDS = 120           # 2 хв вікно
+REMINDERS_RECHECK_SECONDS = 300         # стеля сну reminders_loop без подій
+DEFAULT_NOTICE_MINUTES = 10
+ALLOWED_NOTICE = {5, 10, 30}
+
+SUBQUEUES = tuple(f"{i}.{j}" for i in range(1, 7) for j in (1, 2))
+
+STATE_FILE = "state.json"
+
+# Парсинг
+TIME_RANGE_RE = re.compile(r"(\d{2}:\d{2})\s*-\s*(\d{2}:\d{2})")
+UPDATE_RE = re.compile(r"Оновлено:\s*\d{2}\.\d{2}\.\d{4}\s*\d{2}:\d{2}")
+DATE_RE = re.compile(r"\b(\d{2}\.\d{2}\.\d{4})\b")
+
+# XPath: одразу потрібна таблиця, пошук іде в C (libxml2)
+_SCHEDULE_TABLE_XPATH = (
+    "//table[contains(., 'Підчерга') and contains(., '1.1') and contains(., '6.2')]"
+)
+
+# =========================
+# BOT INIT
+# =========================
+if not BOT_TOKEN:
+    raise RuntimeError("BOT_TOKEN is missing. Add BOT_TOKEN to environment variables.")
+
+# одна довгоживуча сесія для всіх Telegram-запитів (keep-alive замість
+# нового TLS-handshake на кожен send_message)
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession())
+dp = Dispatcher()
+
+# спільна HTTP-сесія (створюється в main, закривається при зупинці)
+SESSION: aiohttp.ClientSession | None = None
+
+# =========================
+# IN-MEMORY STATE
+# =========================
+USER_SUBQUEUE: dict[int, str] = {}
+SUBQUEUE_USERS: dict[str, set[int]] = {}  # зворотний індекс: підчерга -> чати
+USER_NOTICE: dict[int, int] = {}
+
+USER_LAST_HASH: dict[int, str] = {}
+USER_LAST_SCHEDULE: dict[int, dict[str, list[tuple[str, str]]]] = {}
+USER_LAST_UPDATE_MARKER: dict[int, str | None] = {}
+
+USER_NOTIFIED_KEYS: dict[int, set[str]] = {}
+ALL_USERS: set[int] = set()
+
+# cached last global parse (all subqueues)
+_last_global_schedules: dict[str, dict[str, list[tuple[str, str]]]] = {}
+_last_global_update_marker: str | None = None
+
+# умовний GET: заголовки останньої відповіді 200
+_last_etag: str | None = None
+_last_modified: str | None = None
+
+# дайджест останнього розпарсеного HTML (зрізає парсинг ідентичних відповідей)
+_last_html_digest: bytes | None = None
+
+
+def set_user_subqueue(chat_id: int, subqueue: str) -> None:
+    old = USER_SUBQUEUE.get(chat_id)
+    if old and old != subqueue:
+        SUBQUEUE_USERS.get(old, set()).discard(chat_id)
+    USER_SUBQUEUE[chat_id] = subqueue
+    SUBQUEUE_USERS.setdefault(subqueue, set()).add(chat_id)
+
+
+def clear_user_subqueue(chat_id: int) -> None:
+    old = USER_SUBQUEUE.pop(chat_id, None)
+    if old:
+        SUBQUEUE_USERS.get(old, set()).discard(chat_id)
+
+
+# =========================
+# PERSISTENCE
+# =========================
+def load_state() -> None:
+    global USER_SUBQUEUE, USER_NOTICE, ALL_USERS
+    try:
+        if not os.path.exists(STATE_FILE):
+            return
+
+        with open(STATE_FILE, "rb") as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+        users = data.get("users", {})
+        for chat_id_str, u in users.items():
+            try:
+                cid = int(chat_id_str)
+            except ValueError:
+                continue
+
+            ALL_USERS.add(cid)
+
+            sq = (u.get("subqueue") or "").strip()
+            if sq:
+                set_user_subqueue(cid, sq)
+
+            notice = u.get("notice")
+            if isinstance(notice, int) and notice in ALLOWED_NOTICE:
+                USER_NOTICE[cid] = notice
+            else:
+                USER_NOTICE.setdefault(cid, DEFAULT_NOTICE_MINUTES)
+
+    except Exception as e:
+        print(f"[STATE] load_state failed: {e}")
+
+
+def save_state() -> None:
+    try:
+        users_obj: dict[str, dict] = {}
+        for cid in ALL_USERS:
+            users_obj[str(cid)] = {
+                "subqueue": USER_SUBQUEUE.get(cid),
+                "notice": USER_NOTICE.get(cid, DEFAULT_NOTICE_MINUTES),
+            }
+
+        payload = {"users": users_obj}
+        if orjson is not None:
+            raw = orjson.dumps(payload)
+        else:
+            raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        # атомарний запис: tmp + rename, щоб не лишити обрізаний файл
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, STATE_FILE)
+
+    except Exception as e:
+        print(f"[STATE] save_state failed: {e}")
+
+
+# відкладений запис: хендлери лише ставлять прапорець, пише фоновий цикл
+_state_dirty = False
+
+
+def mark_state_dirty() -> None:
+    global _state_dirty
+    _state_dirty = True
+
+
+async def state_flush_loop() -> None:
+    global _state_dirty
+    while True:
+        await asyncio.sleep(5)
+        if _state_dirty:
+            _state_dirty = False
+            await asyncio.to_thread(save_state)
+
+
+def register_user(chat_id: int) -> None:
+    changed = False
+    if chat_id not in ALL_USERS:
+        ALL_USERS.add(chat_id)
+        changed = True
+    if chat_id not in USER_NOTICE:
+        USER_NOTICE[chat_id] = DEFAULT_NOTICE_MINUTES
+        changed = True
+    # перезаписувати state.json на кожне повідомлення не потрібно
+    if changed:
+        mark_state_dirty()
+
+
+# =========================
+# UI (KEYBOARDS)
+# =========================
+# клавіатури незмінні — будуємо один раз при імпорті
+_KB_CHOOSE_SUBQUEUE = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="1.1", callback_data="sq:1.1"),
+     InlineKeyboardButton(text="1.2", callback_data="sq:1.2")],
+    [InlineKeyboardButton(text="2.1", callback_data="sq:2.1"),
+     InlineKeyboardButton(text="2.2", callback_data="sq:2.2")],
+    [InlineKeyboardButton(text="3.1", callback_data="sq:3.1"),
+     InlineKeyboardButton(text="3.2", callback_data="sq:3.2")],
+    [InlineKeyboardButton(text="4.1", callback_data="sq:4.1"),
+     InlineKeyboardButton(text="4.2", callback_data="sq:4.2")],
+    [InlineKeyboardButton(text="5.1", callback_data="sq:5.1"),
+     InlineKeyboardButton(text="5.2", callback_data="sq:5.2")],
+    [InlineKeyboardButton(text="6.1", callback_data="sq:6.1"),
+     InlineKeyboardButton(text="6.2", callback_data="sq:6.2")],
+])
+
+# Кнопки керування (без /next та /schedule)
+_KB_MAIN = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔴 Поточний стан", callback_data="main:status")],
+    [InlineKeyboardButton(text="🔔 Налаштувати попередження", callback_data="main:notice")],
+    [InlineKeyboardButton(text="🔁 Змінити підчергу", callback_data="main:change"),
+     InlineKeyboardButton(text="❌ Вимкнути сповіщення", callback_data="main:stop")],
+])
+
+
+def keyboard_choose_subqueue() -> InlineKeyboardMarkup:
+    return _KB_CHOOSE_SUBQUEUE
+
+
+def keyboard_main() -> InlineKeyboardMarkup:
+    return _KB_MAIN
+
+
+# варіантів лише len(ALLOWED_NOTICE) — кешуємо готові розмітки
+@functools.lru_cache(maxsize=8)
+def keyboard_notice(cur: int) -> InlineKeyboardMarkup:
+    def btn(val: int) -> InlineKeyboardButton:
+        mark = " ✅" if cur == val else ""
+        return InlineKeyboardButton(text=f"⏱ {val} хв{mark}", callback_data=f"notice:{val}")
+
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [btn(5), btn(10), btn(30)],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="main:back")],
+    ])
+
+
+async def send_main_menu(chat_id: int, text: str) -> None:
+    await bot.send_message(chat_id, text, reply_markup=keyboard_main())
+
+
+async def send_many(coros: list) -> None:
+    """
+    Відправляє пачку send-корутин паралельно (семафор < 30 msg/s ліміту Telegram).
+    """
+    if not coros:
+        return
+
+    sem = asyncio.Semaphore(25)
+
+    async def _one(coro) -> None:
+        async with sem:
+            await coro
+
+    await asyncio.gather(*(_one(c) for c in coros), return_exceptions=True)
+
+
+# =========================
+# HTTP / PARSING
+# =========================
+async def fetch_html() -> str | None:
+    """
+    Повертає HTML сторінки або None, якщо сервер відповів 304 (не змінилось).
+    """
+    global _last_etag, _last_modified
+
+    headers: dict[str, str] = {}
+    if _last_etag:
+        headers["If-None-Match"] = _last_etag
+    if _last_modified:
+        headers["If-Modified-Since"] = _last_modified
+
+    async with SESSION.get(URL, headers=headers) as r:
+        if r.status == 304:
+            return None
+        r.raise_for_status()
+        _last_etag = r.headers.get("ETag")
+        _last_modified = r.headers.get("Last-Modified")
+        return await r.text()
+
+
+def _find_update_marker(full_text: str) -> str | None:
+    m = UPDATE_RE.search(full_text)
+    return m.group(0) if m else None
+
+
+def _cell_text(cell) -> str:
+    return " ".join(cell.text_content().split())
+
+
+def _html_table_to_matrix(table) -> list[list[str]]:
+    """
+    Перетворює HTML-таблицю (lxml-елемент) в матрицю з урахуванням rowspan/colspan.
+    """
+    rows = [list(tr.iterchildren("th", "td")) for tr in table.iter("tr")]
+
+    # швидкий шлях: проста сітка без rowspan/colspan — без span-бухгалтерії
+    has_span = any(
+        (cell.get("rowspan") or "1") != "1" or (cell.get("colspan") or "1") != "1"
+        for cells in rows
+        for cell in cells
+    )
+    if not has_span:
+        grid = [[_cell_text(cell) for cell in cells] for cells in rows]
+    else:
+        grid = _matrix_with_spans(rows)
+
+    max_cols = max((len(r) for r in grid), default=0)
+    for r in grid:
+        if len(r) < max_cols:
+            r.extend([""] * (max_cols - len(r)))
+
+    return grid
+
+
+def _matrix_with_spans(rows: list[list]) -> list[list[str]]:
+    grid: list[list[str]] = []
+    # активні rowspan по колонках: плоскі списки замість dict із tuple-ключами
+    active_text: list[str] = []
+    active_left: list[int] = []
+
+    def _ensure_cols(n: int) -> None:
+        while len(active_left) < n:
+            active_text.append("")
+            active_left.append(0)
+
+    for cells in rows:
+        grid_row: list[str] = []
+        c_idx = 0
+
+        def fill_spans_until_free() -> None:
+            nonlocal c_idx
+            while c_idx < len(active_left) and active_left[c_idx] > 0:
+                grid_row.append(active_text[c_idx])
+                c_idx += 1
+
+        for cell in cells:
+            fill_spans_until_free()
+
+            text = _cell_text(cell)
+            rowspan = int(cell.get("rowspan") or 1)
+            colspan = int(cell.get("colspan") or 1)
+
+            _ensure_cols(c_idx + colspan)
+            for _ in range(colspan):
+                grid_row.append(text)
+                if rowspan > 1:
+                    active_text[c_idx] = text
+                    active_left[c_idx] = rowspan
+                c_idx += 1
+
+        # старіння рівно раз на рядок (а не лише при вставці): span не може
+        # пережити свій rowspan, навіть якщо короткий рядок до нього не дійшов
+        fill_spans_until_free()
+        for c in range(len(active_left)):
+            if active_left[c] > 0:
+                active_left[c] -= 1
+                if active_left[c] == 0:
+                    active_text[c] = ""
+
+        grid.append(grid_row)
+
+    return grid
+
+
+def _parse_date_from_row(row: list[str]) -> str | None:
+    for cell in row:
+        # дата завжди містить крапку — дешевий тест перед regex
+        if not cell or "." not in cell:
+            continue
+        m = DATE_RE.search(cell)
+        if m:
+            return m.group(1)
+    return None
+
+
+def parse_all_schedules(html: str) -> tuple[str | None, dict[str, dict[str, list[tuple[str, str]]]]]:
+    """
+    Повертає:
+      update_marker,
+      schedules_all: { "5.1": { "08.02.2026": [("00:00","05:00"), ...], "09.02.2026": [...] }, ... }
+    """
+    # маркер "Оновлено: ..." є в сирому HTML — без get_text по всьому документу
+    update_marker = _find_update_marker(html)
+
+    # дешевий підрядковий тест: без цих маркерів DOM будувати нема сенсу
+    if "Підчерга" not in html or "6.2" not in html:
+        return update_marker, {}
+
+    root = lxml.html.fromstring(html)
+
+    tables = root.xpath(_SCHEDULE_TABLE_XPATH)
+    if not tables:
+        return update_marker, {}
+    table = tables[0]
+
+    matrix = _html_table_to_matrix(table)
+    if not matrix:
+        return update_marker, {}
+
+    col_map: dict[str, int] = {}
+    header_row_idx: int | None = None
+
+    # шукаємо рядок з підчергами (де багато збігів): один прохід по рядку
+    # будує зворотний індекс "текст -> колонка", далі O(1)-пошук міток
+    for r_i, row in enumerate(matrix):
+        cell_to_col: dict[str, int] = {}
+        for c_i, cell in enumerate(row):
+            cell_to_col.setdefault((cell or "").strip(), c_i)
+
+        found = {sq: cell_to_col[sq] for sq in SUBQUEUES if sq in cell_to_col}
+        if len(found) >= 6:
+            header_row_idx = r_i
+            col_map = found
+            break
+
+    if header_row_idx is None or not col_map:
+        return update_marker, {}
+
+    # інтервали збираються в dict-ключі: дедуп відбувається прямо при вставці,
+    # порядок вставки зберігається
+    collected: dict[str, dict[str, dict[tuple[str, str], None]]] = {sq: {} for sq in col_map.keys()}
+    current_date: str | None = None
+
+    for row in matrix[header_row_idx + 1:]:
+        row_date = _parse_date_from_row(row)
+        if row_date:
+            current_date = row_date
+
+        if not current_date:
+            continue
+
+        for sq, c_i in col_map.items():
+            if c_i >= len(row):
+                continue
+            cell_text = (row[c_i] or "").strip()
+            if not cell_text:
+                continue
+            if "Очікується" in cell_text:
+                continue
+            # дешевий підрядковий тест перед запуском regex-движка
+            if ":" not in cell_text:
+                continue
+
+            day_map: dict[tuple[str, str], None] | None = None
+            for m in TIME_RANGE_RE.finditer(cell_text):
+                if day_map is None:
+                    day_map = collected[sq].setdefault(current_date, {})
+                day_map[m.group(1, 2)] = None
+
+    schedules = {
+        sq: {d: list(intervals) for d, intervals in days.items()}
+        for sq, days in collected.items()
+        if days
+    }
+    return update_marker, schedules
+
+
+# унікальних дат мало, а сортування викликає ключ багаторазово
+@functools.lru_cache(maxsize=256)
+def _date_sort_key(d: str) -> tuple[int, int, int]:
+    try:
+        dd, mm, yy = d.split(".")
+        return (int(yy), int(mm), int(dd))
+    except Exception:
+        return (9999, 99, 99)
+
+
+def schedule_hash(schedule_by_day: dict[str, list[tuple[str, str]]]) -> str:
+    # не криптографія, лише детекція змін — blake2b швидший за sha256;
+    # годуємо хешер шматками, без збирання великого проміжного рядка
+    h = hashlib.blake2b(digest_size=16)
+    for d in sorted(schedule_by_day.keys(), key=_date_sort_key):
+        h.update(d.encode("utf-8"))
+        for a, b in schedule_by_day[d]:
+            h.update(f"|{a}-{b}".encode("utf-8"))
+    return h.hexdigest()
+
+
+# хеш порожнього графіка — частий випадок для підчерг без даних
+_EMPTY_HASH = hashlib.blake2b(b"", digest_size=16).hexdigest()
+
+
+def format_schedule_all_days(subqueue: str, schedule_by_day: dict[str, list[tuple[str, str]]], update_marker: str | None) -> str:
+    if not schedule_by_day:
+        msg = (
+            f"Графік (ВІДКЛЮЧЕННЯ) для {subqueue}:\n"
+            f"⚠️ Інтервали не знайдено (можливо “Очікується” або змінилась таблиця)."
+        )
+        if update_marker:
+            msg += f"\n\n{update_marker}"
+        return msg
+
+    lines: list[str] = []
+    for d in sorted(schedule_by_day.keys(), key=_date_sort_key):
+        lines.append(f"{d} (ВІДКЛЮЧЕННЯ):")
+        for a, b in schedule_by_day[d]:
+            lines.append(f"• {a}–{b}")
+        lines.append("")
+
+    msg = "\n".join(lines).strip()
+    if update_marker:
+        msg += f"\n\n{update_marker}"
+    return msg
+
+
+# готовий текст графіка: (підчерга, хеш, маркер) -> рядок
+_FMT_CACHE: dict[tuple[str, str, str | None], str] = {}
+
+
+def format_schedule_cached(
+    subqueue: str,
+    schedule_by_day: dict[str, list[tuple[str, str]]],
+    update_marker: str | None,
+    sched_hash: str | None = None,
+) -> str:
+    h = sched_hash or (schedule_hash(schedule_by_day) if schedule_by_day else _EMPTY_HASH)
+    key = (subqueue, h, update_marker)
+    msg = _FMT_CACHE.get(key)
+    if msg is None:
+        if len(_FMT_CACHE) > 256:
+            _FMT_CACHE.clear()
+        msg = format_schedule_all_days(subqueue, schedule_by_day, update_marker)
+        _FMT_CACHE[key] = msg
+    return msg
+
+
+def _dt_for_date(d_str: str, hhmm: str) -> datetime:
+    dd, mm, yy = d_str.split(".")
+    hh, mn = hhmm.split(":")
+    return datetime(int(yy), int(mm), int(dd), int(hh), int(mn), 0, tzinfo=TZ)
+
+
+def _interval_end_dt(d_str: str, hhmm: str) -> datetime:
+    dt = _dt_for_date(d_str, hhmm)
+    if hhmm == "23:59":
+        dt = dt.replace(second=59)
+    return dt
+
+
+def _ddmmyyyy(dt: datetime) -> str:
+    # f-string замість strftime: без парсингу формату на кожен виклик
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year:04d}"
+
+
+def _hhmm(dt: datetime) -> str:
+    return f"{dt.hour:02d}:{dt.minute:02d}"
+
+
+# кеш "HH:MM"-рядки -> datetime для одного дня (щоб не парсити щохвилини)
+_INTERVALS_DT_CACHE: dict[tuple[str, tuple[tuple[str, str], ...]], list[tuple[datetime, datetime]]] = {}
+
+
+def _intervals_dt(d_str: str, intervals: list[tuple[str, str]]) -> list[tuple[datetime, datetime]]:
+    key = (d_str, tuple(intervals))
+    cached = _INTERVALS_DT_CACHE.get(key)
+    if cached is None:
+        if len(_INTERVALS_DT_CACHE) > 512:
+            _INTERVALS_DT_CACHE.clear()
+        cached = [(_dt_for_date(d_str, a), _interval_end_dt(d_str, b)) for a, b in intervals]
+        _INTERVALS_DT_CACHE[key] = cached
+    return cached
+
+
+def is_off_now(schedule_by_day: dict[str, list[tuple[str, str]]], now: datetime) -> bool:
+    today_str = _ddmmyyyy(now)
+    for st, en in _intervals_dt(today_str, schedule_by_day.get(today_str, [])):
+        if st <= now <= en:
+            return True
+    return False
+
+
+# плаский відсортований список інтервалів на графік (для bisect-пошуку)
+_FLAT_INTERVALS_CACHE: dict[tuple, tuple[list[datetime], list[tuple[datetime, datetime]]]] = {}
+
+
+def _flat_intervals(schedule_by_day: dict[str, list[tuple[str, str]]]) -> tuple[list[datetime], list[tuple[datetime, datetime]]]:
+    key = tuple(sorted((d, tuple(iv)) for d, iv in schedule_by_day.items()))
+    cached = _FLAT_INTERVALS_CACHE.get(key)
+    if cached is None:
+        if len(_FLAT_INTERVALS_CACHE) > 64:
+            _FLAT_INTERVALS_CACHE.clear()
+        pairs: list[tuple[datetime, datetime]] = []
+        for d, intervals in schedule_by_day.items():
+            pairs.extend(_intervals_dt(d, intervals))
+        pairs.sort(key=lambda p: p[0])
+        starts = [p[0] for p in pairs]
+        cached = (starts, pairs)
+        _FLAT_INTERVALS_CACHE[key] = cached
+    return cached
+
+
+def next_event(schedule_by_day: dict[str, list[tuple[str, str]]], now: datetime) -> tuple[datetime | None, str | None]:
+    starts, pairs = _flat_intervals(schedule_by_day)
+    if not pairs:
+        return None, None
+
+    i = bisect.bisect_right(starts, now)
+
+    # якщо зараз OFF - найближче ON (кінець поточного інтервалу);
+    # інтервали відключень не перетинаються, тож достатньо попереднього старту
+    if i > 0:
+        st, en = pairs[i - 1]
+        if st <= now <= en:
+            return en, "ON"
+
+    # інакше найближчий старт OFF у майбутньому
+    if i < len(pairs):
+        return starts[i], "OFF"
+
+    return None, None
+
+
+# =========================
+# LOOPS
+# =========================
+async def process_site_once(send_updates: bool = True) -> None:
+    global _last_global_schedules, _last_global_update_marker, _last_html_digest
+
+    html = await fetch_html()
+    if html is None:
+        # 304 Not Modified — парсити нічого, але звірку по користувачах нижче
+        # все одно робимо: контент міг прийти через інший шлях (вибір підчерги
+        # без розсилки), і в підписників ще старі хеші
+        digest = _last_html_digest
+        html_unchanged = True
+    else:
+        digest = hashlib.blake2b(html.encode("utf-8"), digest_size=16).digest()
+        html_unchanged = digest == _last_html_digest
+
+    if html_unchanged:
+        # байти ті самі (304 або ідентична 200) — кешований парс актуальний
+        update_marker = _last_global_update_marker
+        schedules_all = _last_global_schedules
+    else:
+        # парсинг — синхронна CPU-робота, не блокуємо event loop
+        update_marker, schedules_all = await asyncio.to_thread(parse_all_schedules, html)
+        _last_html_digest = digest
+        _last_global_schedules = schedules_all
+        _last_global_update_marker = update_marker
+
+    pending_sends: list = []
+
+    for subqueue, chat_ids in SUBQUEUE_USERS.items():
+        if not chat_ids:
+            continue
+
+        schedule_by_day = schedules_all.get(subqueue, {})
+        # хеш і текст рахуються один раз на підчергу, не на користувача
+        new_hash = schedule_hash(schedule_by_day) if schedule_by_day else _EMPTY_HASH
+
+        # HTML не змінився і всі користувачі підчерги вже на цьому хеші — нічого
+        # робити (саме збіг хешів, а не наявність: хеш міг лишитись старим після
+        # проходу без розсилки)
+        if html_unchanged and all(USER_LAST_HASH.get(cid) == new_hash for cid in chat_ids):
+            continue
+
+        text: str | None = None
+
+        for chat_id in list(chat_ids):
+            USER_LAST_SCHEDULE[chat_id] = schedule_by_day
+            USER_LAST_UPDATE_MARKER[chat_id] = update_marker
+
+            old_hash = USER_LAST_HASH.get(chat_id)
+
+            if old_hash is None:
+                USER_LAST_HASH[chat_id] = new_hash
+                USER_NOTIFIED_KEYS.setdefault(chat_id, set())
+                continue
+
+            if send_updates and new_hash != old_hash:
+                USER_LAST_HASH[chat_id] = new_hash
+                USER_NOTIFIED_KEYS[chat_id] = set()
+                wake_reminders()
+
+                if text is None:
+                    text = (
+                        f"🔄 Оновився графік по підчерзі {subqueue}\n\n"
+                        f"{format_schedule_cached(subqueue, schedule_by_day, update_marker, new_hash)}"
+                    )
+                pending_sends.append(send_main_menu(chat_id, text))
+
+    await send_many(pending_sends)
+
+
+async def site_watcher_loop() -> None:
+    backoff = SITE_CHECK_EVERY_SECONDS
+    while True:
+        delay = SITE_CHECK_EVERY_SECONDS
+        try:
+            if USER_SUBQUEUE:
+                await process_site_once(send_updates=True)
+            backoff = SITE_CHECK_EVERY_SECONDS
+        except Exception as e:
+            print(f"[WATCHER] loop error: {e}")
+            # експоненційний backoff з джитером, щоб не довбати лежачий сайт у такт
+            backoff = min(backoff * 2, 3600)
+            delay = backoff + random.uniform(0, backoff * 0.1)
+        await asyncio.sleep(delay)
+
+
+# будильник: ставиться, коли графік/налаштування змінились і треба перерахувати сон
+_reminders_wakeup: asyncio.Event = asyncio.Event()
+
+
+def wake_reminders() -> None:
+    _reminders_wakeup.set()
+
+
+async def reminders_loop() -> None:
+    while True:
+        sleep_for = float(REMINDERS_RECHECK_SECONDS)
+        try:
+            now = datetime.now(TZ)
+            # далі лише ціла/float-арифметика, без timedelta-алокацій
+            now_ts = now.timestamp()
+            day_key = f"{now.year:04d}-{now.month:02d}-{now.day:02d}"
+            next_wake_ts: float | None = None
+            pending_sends: list = []
+
+            for subqueue, chat_ids in SUBQUEUE_USERS.items():
+                if not chat_ids:
+                    continue
+
+                sq_schedule = _last_global_schedules.get(subqueue, {})
+                # графік спільний для всієї підчерги — найближча подія рахується один раз
+                sq_event = next_event(sq_schedule, now) if sq_schedule else (None, None)
+
+                for chat_id in list(chat_ids):
+                    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or sq_schedule
+                    if not schedule_by_day:
+                        continue
+
+                    notice = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
+                    if notice not in ALLOWED_NOTICE:
+                        notice = DEFAULT_NOTICE_MINUTES
+                        USER_NOTICE[chat_id] = notice
+
+                    notified = USER_NOTIFIED_KEYS.setdefault(chat_id, set())
+
+                    if schedule_by_day is sq_schedule:
+                        event_dt, event_type = sq_event
+                    else:
+                        event_dt, event_type = next_event(schedule_by_day, now)
+                    if not event_dt or not event_type:
+                        continue
+
+                    event_ts = event_dt.timestamp()
+                    notify_ts = event_ts - notice * 60
+
+                    # наступні точки пробудження: саме попередження та зміна стану
+                    for candidate_ts in (notify_ts, event_ts):
+                        if candidate_ts > now_ts and (next_wake_ts is None or candidate_ts < next_wake_ts):
+                            next_wake_ts = candidate_ts
+
+                    if notify_ts <= now_ts < notify_ts + PREALERT_WINDOW_SECONDS:
+                        key = f"{day_key}|{subqueue}|{event_type}|{event_dt.isoformat()}|{notice}"
+                        if key in notified:
+                            continue
+                        notified.add(key)
+
+                        hhmm = _hhmm(event_dt)
+
+                        # OFF = відключення, ON = відновлення
+                        if event_type == "OFF":
+                            text = f"❌ За {notice} хвилин можливе відключення світла (о {hhmm})"
+                        else:
+                            text = f"✅ За {notice} хвилин очікується відновлення світла (о {hhmm})"
+
+                        pending_sends.append(bot.send_message(chat_id, text))
+
+            await send_many(pending_sends)
+
+            if next_wake_ts is not None:
+                sleep_for = min(sleep_for, max(next_wake_ts - now_ts, 1.0))
+
+        except Exception as e:
+            print(f"[REMINDERS] loop error: {e}")
+            sleep_for = 60.0
+
+        try:
+            await asyncio.wait_for(_reminders_wakeup.wait(), timeout=sleep_for)
+        except asyncio.TimeoutError:
+            pass
+        _reminders_wakeup.clear()
+
+
+# =========================
+# USER HELPERS
+# =========================
+def build_status_text(chat_id: int) -> str:
+    subqueue = USER_SUBQUEUE.get(chat_id)
+    if not subqueue:
+        return "⚠️ Спочатку обери підчергу через /start"
+
+    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
+    if not schedule_by_day:
+        return "⚠️ Зараз немає даних по графіку (можливо 'Очікується'). Спробуй /schedule пізніше."
+
+    now = datetime.now(TZ)
+    off = is_off_now(schedule_by_day, now)
+    ev_dt, ev_type = next_event(schedule_by_day, now)
+
+    txt = "❌ ЗАРАЗ ВІДКЛЮЧЕННЯ" if off else "✅ ЗАРАЗ Є СВІТЛО"
+    tail = ""
+    if ev_dt and ev_type:
+        hhmm = _hhmm(ev_dt)
+        if ev_type == "OFF":
+            tail = f"\nНайближче: відключення о {hhmm}"
+        else:
+            tail = f"\nНайближче: відновлення о {hhmm}"
+
+    return f"{txt}\nПідчерга: {subqueue}{tail}"
+
+
+# =========================
+# USER COMMANDS
+# =========================
+@dp.message(F.text == "/start")
+async def start(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+
+    await message.answer(
+        "Оберіть вашу підчергу.\n👇 Натисни кнопку:",
+        reply_markup=keyboard_choose_subqueue()
+    )
+
+
+@dp.message(F.text == "/status")
+async def cmd_status(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+    await send_main_menu(chat_id, build_status_text(chat_id))
+
+
+@dp.message(F.text == "/notice")
+async def cmd_notice(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+    cur = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
+    await message.answer(
+        f"Оберіть за скільки хвилин попереджати.\nПоточне: {cur} хв",
+        reply_markup=keyboard_notice(cur)
+    )
+
+
+@dp.message(F.text == "/change")
+async def cmd_change(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+    await message.answer("Ок, обери нову підчергу 👇", reply_markup=keyboard_choose_subqueue())
+
+
+@dp.message(F.text == "/stop")
+async def cmd_stop(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+
+    clear_user_subqueue(chat_id)
+    USER_LAST_HASH.pop(chat_id, None)
+    USER_LAST_SCHEDULE.pop(chat_id, None)
+    USER_LAST_UPDATE_MARKER.pop(chat_id, None)
+    USER_NOTIFIED_KEYS.pop(chat_id, None)
+
+    mark_state_dirty()
+    await message.answer("Сповіщення вимкнув ✅\nЩоб знову увімкнути — натисни /start")
+
+
+# Технічні команди (без кнопок)
+@dp.message(F.text == "/schedule")
+async def cmd_schedule(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+
+    subqueue = USER_SUBQUEUE.get(chat_id)
+    if not subqueue:
+        await message.answer("⚠️ Спочатку обери підчергу через /start")
+        return
+
+    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
+    update_marker = USER_LAST_UPDATE_MARKER.get(chat_id) or _last_global_update_marker
+    await send_main_menu(chat_id, format_schedule_cached(subqueue, schedule_by_day, update_marker))
+
+
+@dp.message(F.text == "/next")
+async def cmd_next(message: Message) -> None:
+    chat_id = message.chat.id
+    register_user(chat_id)
+
+    subqueue = USER_SUBQUEUE.get(chat_id)
+    if not subqueue:
+        await message.answer("⚠️ Спочатку обери підчергу через /start")
+        return
+
+    schedule_by_day = USER_LAST_SCHEDULE.get(chat_id) or _last_global_schedules.get(subqueue, {})
+    if not schedule_by_day:
+        await message.answer("⚠️ Немає даних по графіку (можливо 'Очікується').")
+        return
+
+    now = datetime.now(TZ)
+    ev_dt, ev_type = next_event(schedule_by_day, now)
+    if not ev_dt or not ev_type:
+        await message.answer("⚠️ Немає наступних подій у доступному графіку.")
+        return
+
+    hhmm = _hhmm(ev_dt)
+    dstr = _ddmmyyyy(ev_dt)
+    if ev_type == "OFF":
+        await send_main_menu(chat_id, f"❌ Наступне відключення: {dstr} о {hhmm}")
+    else:
+        await send_main_menu(chat_id, f"✅ Наступне відновлення: {dstr} о {hhmm}")
+
+
+# =========================
+# CALLBACKS
+# =========================
+CB_SUBQUEUES = frozenset(f"sq:{sq}" for sq in SUBQUEUES)
+
+
+@dp.callback_query(F.data.in_(CB_SUBQUEUES))
+async def choose_subqueue(cb: CallbackQuery) -> None:
+    if cb.message is None:
+        return
+
+    chat_id = cb.message.chat.id
+    register_user(chat_id)
+
+    subqueue = cb.data[3:]  # "sq:X.Y" -> "X.Y", значення з CB_SUBQUEUES
+    set_user_subqueue(chat_id, subqueue)
+    USER_NOTIFIED_KEYS.setdefault(chat_id, set())
+    mark_state_dirty()
+
+    await cb.answer()
+
+    try:
+        # оновити кеш з сайту (без пушів)
+        await process_site_once(send_updates=False)
+
+        schedule_by_day = _last_global_schedules.get(subqueue, {})
+        update_marker = _last_global_update_marker
+
+        USER_LAST_SCHEDULE[chat_id] = schedule_by_day
+        USER_LAST_UPDATE_MARKER[chat_id] = update_marker
+        USER_LAST_HASH[chat_id] = schedule_hash(schedule_by_day)
+        USER_NOTIFIED_KEYS[chat_id] = set()
+        wake_reminders()
+
+        notice = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
+
+        text = (
+            f"✅ Підчерга {subqueue} обрана\n"
+            f"⏱ Попередження: за {notice} хв\n\n"
+            f"{format_schedule_cached(subqueue, schedule_by_day, update_marker)}"
+        )
+        await send_main_menu(chat_id, text)
+
+    except Exception as e:
+        print(f"[CHOOSE] failed: {e}")
+        await send_main_menu(
+            chat_id,
+            f"✅ Підчерга {subqueue} обрана\n\n"
+            "⚠️ Не зміг зараз отримати графік із сайту. Спробуй ще раз через хвилину."
+        )
+
+
+@dp.callback_query(F.data.startswith("main:"))
+async def main_buttons(cb: CallbackQuery) -> None:
+    if cb.message is None:
+        return
+
+    chat_id = cb.message.chat.id
+    register_user(chat_id)
+
+    action = cb.data[5:]  # зрізаємо префікс "main:"
+    await cb.answer()
+
+    if action == "status":
+        await send_main_menu(chat_id, build_status_text(chat_id))
+        return
+
+    if action == "notice":
+        cur = USER_NOTICE.get(chat_id, DEFAULT_NOTICE_MINUTES)
+        await cb.message.answer(
+            f"Оберіть за скільки хвилин попереджати.\nПоточне: {cur} хв",
+            reply_markup=keyboard_notice(cur)
+        )
+        return
+
+    if action == "change":
+        await cb.message.answer("Ок, обери нову підчергу 👇", reply_markup=keyboard_choose_subqueue())
+        return
+
+    if action == "stop":
+        clear_user_subqueue(chat_id)
+        USER_LAST_HASH.pop(chat_id, None)
+        USER_LAST_SCHEDULE.pop(chat_id, None)
+        USER_LAST_UPDATE_MARKER.pop(chat_id, None)
+        USER_NOTIFIED_KEYS.pop(chat_id, None)
+        mark_state_dirty()
+
+        await cb.message.answer("Сповіщення вимкнув ✅\nЩоб знову увімкнути — натисни /start")
+        return
+
+    if action == "back":
+        await send_main_menu(chat_id, build_status_text(chat_id))
+        return
+
+
+@dp.callback_query(F.data.startswith("notice:"))
+async def choose_notice(cb: CallbackQuery) -> None:
+    if cb.message is None:
+        return
+
+    chat_id = cb.message.chat.id
+    register_user(chat_id)
+
+    try:
+        val = int(cb.data[7:])  # зрізаємо префікс "notice:"
+    except ValueError:
+        await cb.answer("Помилка", show_alert=True)
+        return
+
+    if val not in ALLOWED_NOTICE:
+        await cb.answer("Доступно: 5/10/30", show_alert=True)
+        return
+
+    USER_NOTICE[chat_id] = val
+    mark_state_dirty()
+    wake_reminders()
+
+    await cb.answer("Збережено ✅")
+    await send_main_menu(chat_id, f"✅ Ок. Попереджатиму за {val} хв до події.")
+
+
+# =========================
+# ADMIN COMMANDS
+# =========================
+def is_admin(message: Message) -> bool:
+    return ADMIN_ID != 0 and message.from_user and message.from_user.id == ADMIN_ID
+
+
+@dp.message(F.text.startswith("/bc"))
+async def admin_broadcast(message: Message) -> None:
+    if not is_admin(message):
+        return
+
+    text = message.text.replace("/bc", "", 1).strip()
+    if not text:
+        await message.answer("Формат:\n/bc ваш текст повідомлення")
+        return
+
+    # паралельна розсилка, семафор < 30 msg/s ліміту Telegram
+    sem = asyncio.Semaphore(25)
+
+    async def send_one(cid: int) -> bool:
+        async with sem:
+            try:
+                await bot.send_message(cid, text)
+                return True
+            except TelegramRetryAfter as e:
+                # flood-ліміт: чекаємо скільки попросив Telegram і пробуємо ще раз
+                await asyncio.sleep(e.retry_after)
+                try:
+                    await bot.send_message(cid, text)
+                    return True
+                except Exception:
+                    return False
+            except Exception:
+                return False
+
+    results = await asyncio.gather(*(send_one(cid) for cid in list(ALL_USERS)))
+    ok = sum(results)
+    fail = len(results) - ok
+
+    await message.answer(f"Розсилка: ✅{ok} ❌{fail}")
+
+
+@dp.message(F.text == "/stats")
+async def admin_stats(message: Message) -> None:
+    if not is_admin(message):
+        return
+
+    total = len(ALL_USERS)
+    active = len(USER_SUBQUEUE)
+    await message.answer(
+        f"📊 Статистика:\n"
+        f"👥 Всього користувачів: {total}\n"
+        f"🔔 З активними сповіщеннями: {active}"
+    )
+
+
+@dp.message(F.text == "/force")
+async def admin_force(message: Message) -> None:
+    if not is_admin(message):
+        return
+
+    await message.answer("⏳ Ок, перевіряю сайт зараз...")
+    try:
+        await process_site_once(send_updates=True)
+        await message.answer("✅ Готово.")
+    except Exception as e:
+        await message.answer(f"⚠️ Помилка: {e}")
+
+
+@dp.message(F.text == "/time")
+async def admin_time(message: Message) -> None:
+    if not is_admin(message):
+        return
+    now = datetime.now(TZ)
+    stamp = f"{_ddmmyyyy(now)} {_hhmm(now)}:{now.second:02d}"
+    await message.answer(f"Server time: {stamp} (Europe/Kyiv)")
+
+
+# =========================
+# MAIN
+# =========================
+async def main() -> None:
+    global SESSION
+
+    load_state()
+
+    SESSION = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=25),
+        connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=120, ttl_dns_cache=600),
+        # явний gzip: таблиці стискаються в рази, aiohttp розпаковує сам
+        headers={"Accept-Encoding": "gzip, deflate", "User-Agent": "roe-light-bot/1.0"},
+    )
+
+    tasks: list[asyncio.Task] = []
+    try:
+        # Initial fetch (non-fatal)
+        try:
+            await process_site_once(send_updates=False)
+        except Exception as e:
+            print(f"[INIT] initial fetch failed: {e}")
+
+        tasks.append(asyncio.create_task(site_watcher_loop(), name="site_watcher"))
+        tasks.append(asyncio.create_task(reminders_loop(), name="reminders"))
+        tasks.append(asyncio.create_task(state_flush_loop(), name="state_flush"))
+
+        # start_polling сам обробляє SIGINT/SIGTERM і повертається
+        await dp.start_polling(bot)
+    finally:
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if _state_dirty:
+            save_state()
+        await SESSION.close()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())